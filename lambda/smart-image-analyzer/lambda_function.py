@@ -6,131 +6,313 @@ High-performance image analysis using Claude Sonnet 4 Vision API
 
 import json
 import base64
+import binascii
+import gzip
+import hashlib
 import boto3
 import logging
 import os
-from typing import Dict, Any
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+from botocore.config import Config
+from botocore.exceptions import ClientError, ParamValidationError
+
+try:
+    import orjson
+
+    def _json_loads(data: Any) -> Any:
+        return orjson.loads(data)
+
+    def _json_dumps(obj: Any) -> str:
+        # orjson always emits UTF-8 without escaping non-ASCII (same as ensure_ascii=False)
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    def _json_loads(data: Any) -> Any:
+        return json.loads(data)
+
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False)
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Environment configuration (resolved once per execution environment)
+MODEL_ID = os.environ.get('BEDROCK_MODEL_ID', 'us.anthropic.claude-sonnet-4-20250514-v1:0')
+REGION = os.environ.get('BEDROCK_REGION', 'us-east-1')
+MAX_TOKENS = int(os.environ.get('MAX_TOKENS', '4000'))
+TEMPERATURE = float(os.environ.get('TEMPERATURE', '0.1'))
+
+# 'optimized' requests latency-optimized inference (only some models support it)
+BEDROCK_LATENCY = os.environ.get('BEDROCK_LATENCY', 'standard').lower()
+_latency_optimized = BEDROCK_LATENCY == 'optimized'
+
+# Bedrock rejects images above 3.75 MB; reject them before calling it
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', '3750000'))
+
+# Adaptive retries smooth out throttling bursts; short connect timeout fails fast
+BEDROCK_CONFIG = Config(
+    retries={
+        'max_attempts': int(os.environ.get('BEDROCK_MAX_ATTEMPTS', '4')),
+        'mode': 'adaptive'
+    },
+    connect_timeout=int(os.environ.get('BEDROCK_CONNECT_TIMEOUT', '5')),
+    tcp_keepalive=True
+)
+
+# Bedrock client is created at cold start and reused across warm invocations
+bedrock = boto3.client('bedrock-runtime', region_name=REGION, config=BEDROCK_CONFIG)
+
+# Upper bound (seconds) for the INIT-time connection prewarm; INIT itself is capped at 10 s
+PREWARM_TIMEOUT = float(os.environ.get('PREWARM_TIMEOUT', '1.5'))
+
+def _prewarm_bedrock_connection() -> None:
+    """
+    Open the HTTPS connection to Bedrock during INIT
+    An unsigned HEAD through the client's own urllib3 pool completes the TLS
+    handshake and leaves a keep-alive connection for the first real request.
+    It uses its own short timeout and no retries so a slow endpoint cannot
+    stall INIT
+    """
+    try:
+        url = bedrock.meta.endpoint_url
+        http_session = bedrock._endpoint.http_session
+        conn = http_session._get_connection_manager(url).connection_from_url(url)
+        # botocore loads its CA bundle onto the pool per send; do the same or the handshake fails
+        http_session._setup_ssl_cert(conn, url, http_session._verify)
+        conn.urlopen('HEAD', '/', timeout=PREWARM_TIMEOUT, retries=False)
+    except Exception as e:
+        logger.warning(f"Bedrock connection prewarm skipped: {str(e)}")
+
+def _warmup() -> None:
+    """
+    Prime per-environment state during INIT
+    With provisioned concurrency this runs before any request arrives
+    """
+    try:
+        # botocore resolves operation shapes lazily on the first call; do it now
+        operation = bedrock.meta.service_model.operation_model('Converse')
+        operation.input_shape
+        operation.output_shape
+    except Exception as e:
+        logger.warning(f"Bedrock model warmup skipped: {str(e)}")
+
+    if os.environ.get('PREWARM_BEDROCK', 'true').lower() == 'true':
+        _prewarm_bedrock_connection()
+
+_warmup()
+
+# CORS headers shared by every response
+CORS_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type",
+    "Access-Control-Allow-Methods": "OPTIONS,POST"
+}
+ERROR_HEADERS = {
+    "Content-Type": "application/json"
+}
+
+# Enhanced system prompt for business analysis
+SYSTEM_PROMPT = """あなたは高精度なビジネス文書・データ分析の専門家です。
+
+**OCR・テキスト抽出タスク:**
+- 文字や数値は1文字も見落とさず、完全に正確に読み取る
+- 表・グラフ・チャートの数値データは全て漏れなく抽出
+- 曖昧な文字は文脈から推測して最も適切な解釈を提示
+- レイアウト構造（表の行列関係、見出し階層）を正確に把握
+
+**データ分析タスク:**
+1. **構造的データ読み取り**: 表・グラフの全データを体系的に抽出
+2. **数値計算**: ROI、増減率、平均値、合計値等を正確に算出
+3. **トレンド分析**: 時系列変化、パフォーマンス比較、パターン発見
+4. **ビジネス洞察**: 戦略的示唆、改善提案、リスク要因の特定
+5. **具体的推奨**: 実行可能なアクションプランの提示
+
+**出力形式:**
+- 抽出データは表形式で整理
+- 重要な数値は具体的に明記
+- 分析結果は論理的な構造で整理
+- 日本語で専門的かつ分かりやすく記述
+
+精度と詳細性を最優先とし、推測ではなく画像から確実に読み取れる情報のみを報告してください。"""
+
+# Converse request fields that are identical for every invocation
+CONVERSE_BASE_PARAMS = {
+    "modelId": MODEL_ID,
+    "system": [{"text": SYSTEM_PROMPT}],
+    "inferenceConfig": {
+        "maxTokens": MAX_TOKENS,
+        "temperature": TEMPERATURE
+    }
+}
+
+# Warm-container cache of analysis results (only used when TEMPERATURE is 0,
+# since sampled outputs are not reproducible)
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '64'))
+_result_cache: "OrderedDict[str, str]" = OrderedDict()
+
+# Responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Smart Image Analysis Lambda Handler
     Processes images with Claude Sonnet 4 for business intelligence
     """
-    logger.info(f"Event received: {json.dumps(event, default=str)}")
-
     try:
-        # CORS headers
-        headers = {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "Content-Type",
-            "Access-Control-Allow-Methods": "OPTIONS,POST"
-        }
-
         # HTTP method detection for Function URLs
         http_method = event.get('httpMethod') or event.get('requestContext', {}).get('http', {}).get('method')
 
+        # Log the event shape only; the body carries the full base64 image
+        raw_body = event.get('body')
+        logger.info(
+            "Event received: method=%s keys=%s body_len=%d",
+            http_method,
+            list(event.keys()),
+            len(raw_body) if isinstance(raw_body, (str, bytes)) else 0
+        )
+
         # Handle CORS preflight
         if http_method == 'OPTIONS':
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({'message': 'CORS preflight successful'})
-            }
+            return response_builder(200, {'message': 'CORS preflight successful'})
 
         # Only allow POST requests
         if http_method != 'POST':
-            return {
-                'statusCode': 405,
-                'headers': headers,
-                'body': json.dumps({'error': f'Method {http_method} not allowed'})
-            }
-
-        # Parse request body
-        body = event.get('body', '{}')
-        if isinstance(body, str):
-            data = json.loads(body)
+            return response_builder(405, {'error': f'Method {http_method} not allowed'})
+
+        # Parse request body (str, bytes, base64-wrapped or already a dict)
+        body = event.get('body') or '{}'
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        if isinstance(body, (str, bytes)):
+            data = _json_loads(body)
         else:
             data = body
 
         # Validate required fields
         if 'image_data' not in data:
-            return {
-                'statusCode': 400,
-                'headers': headers,
-                'body': json.dumps({'error': 'image_data is required'})
-            }
+            return response_builder(400, {'error': 'image_data is required'})
+
+        if not isinstance(data['image_data'], str) or not data['image_data']:
+            return response_builder(400, {'error': 'image_data must be a non-empty base64 string'})
+
+        # Strip a data URL prefix if the client sent one
+        if data['image_data'].startswith('data:'):
+            data['image_data'] = data['image_data'].split(',', 1)[-1]
+
+        # Decode here so the size limit applies to the image bytes, not to
+        # line breaks or whitespace in the base64 text
+        try:
+            image_bytes = base64.b64decode(data['image_data'])
+        except binascii.Error:
+            return response_builder(400, {'error': 'image_data is not valid base64'})
+
+        # Reject oversized images before calling Bedrock
+        if len(image_bytes) > MAX_IMAGE_BYTES:
+            return response_builder(413, {'error': f'image_data exceeds {MAX_IMAGE_BYTES} bytes'})
 
         # Extract parameters
         prompt = data.get('prompt', 'この画像を詳細に分析してください。')
-        image_data = data['image_data']
 
         # Analyze image with Claude Vision API
-        result = analyze_image_with_claude(image_data, prompt)
+        result = analyze_image_with_claude(image_bytes, prompt)
 
-        return {
-            'statusCode': 200,
-            'headers': headers,
-            'body': json.dumps({
-                'result': result,
-                'status': 'success'
-            }, ensure_ascii=False)
-        }
+        return gzip_response(response_builder(200, {
+            'result': result,
+            'status': 'success'
+        }), event)
 
     except Exception as e:
         logger.error(f"Analysis error: {str(e)}", exc_info=True)
-        return {
-            'statusCode': 500,
-            'headers': {
-                "Content-Type": "application/json"
-            },
-            'body': json.dumps({
-                'error': str(e),
-                'status': 'error'
-            })
-        }
-
-def analyze_image_with_claude(image_data: str, prompt: str) -> str:
+        return response_builder(500, {
+            'error': str(e),
+            'status': 'error'
+        }, ERROR_HEADERS)
+
+def response_builder(status_code: int, body: Dict[str, Any], headers: Dict[str, str] = CORS_HEADERS) -> Dict[str, Any]:
     """
-    Analyze image using Claude Sonnet 4 Vision API via AWS Bedrock
+    Build a Lambda proxy response with a compact JSON body
     """
-    # Environment configuration
-    model_id = os.environ.get('BEDROCK_MODEL_ID', 'us.anthropic.claude-sonnet-4-20250514-v1:0')
-    region = os.environ.get('BEDROCK_REGION', 'us-east-1')
-    max_tokens = int(os.environ.get('MAX_TOKENS', '4000'))
-    temperature = float(os.environ.get('TEMPERATURE', '0.1'))
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': _json_dumps(body)
+    }
 
-    try:
-        # Initialize Bedrock client
-        bedrock = boto3.client('bedrock-runtime', region_name=region)
+def gzip_response(response: Dict[str, Any], event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Gzip the response body when the client accepts it and the body is large enough
+    Level 1 keeps CPU time low while still shrinking Japanese analysis text well
+    """
+    # Header names are case-insensitive (Function URLs lower-case them, REST APIs may not)
+    request_headers = event.get('headers') or {}
+    accept_encoding = next(
+        (value for name, value in request_headers.items() if name.lower() == 'accept-encoding'), ''
+    )
+    if 'gzip' not in (accept_encoding or '').lower():
+        return response
 
-        # Enhanced system prompt for business analysis
-        system_prompt = """あなたは高精度なビジネス文書・データ分析の専門家です。
+    body = response['body'].encode('utf-8')
+    if len(body) < GZIP_MIN_BYTES:
+        return response
 
-**OCR・テキスト抽出タスク:**
-- 文字や数値は1文字も見落とさず、完全に正確に読み取る
-- 表・グラフ・チャートの数値データは全て漏れなく抽出
-- 曖昧な文字は文脈から推測して最も適切な解釈を提示
-- レイアウト構造（表の行列関係、見出し階層）を正確に把握
+    return {
+        **response,
+        'headers': {**response['headers'], 'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'},
+        'body': base64.b64encode(gzip.compress(body, compresslevel=1)).decode('ascii'),
+        'isBase64Encoded': True
+    }
 
-**データ分析タスク:**
-1. **構造的データ読み取り**: 表・グラフの全データを体系的に抽出
-2. **数値計算**: ROI、増減率、平均値、合計値等を正確に算出
-3. **トレンド分析**: 時系列変化、パフォーマンス比較、パターン発見
-4. **ビジネス洞察**: 戦略的示唆、改善提案、リスク要因の特定
-5. **具体的推奨**: 実行可能なアクションプランの提示
+def result_cache_key(prompt: str, image_bytes: bytes) -> Optional[str]:
+    """
+    Digest of the prompt and image, or None when results must not be cached
+    """
+    if RESULT_CACHE_SIZE <= 0 or TEMPERATURE != 0:
+        return None
+    digest = hashlib.blake2b(prompt.encode('utf-8'), digest_size=16)
+    digest.update(b'\0')
+    digest.update(image_bytes)
+    return digest.hexdigest()
 
-**出力形式:**
-- 抽出データは表形式で整理
-- 重要な数値は具体的に明記
-- 分析結果は論理的な構造で整理
-- 日本語で専門的かつ分かりやすく記述
+def invoke_converse(messages: list) -> Dict[str, Any]:
+    """
+    Call Bedrock Converse, requesting latency-optimized inference when enabled
+    Unsupported models reject performanceConfig with a ValidationException and
+    older botocore builds with a ParamValidationError; in either case stop
+    sending it for the rest of the container's life and retry once without it
+    """
+    global _latency_optimized
+    if not _latency_optimized:
+        return bedrock.converse(messages=messages, **CONVERSE_BASE_PARAMS)
 
-精度と詳細性を最優先とし、推測ではなく画像から確実に読み取れる情報のみを報告してください。"""
+    try:
+        return bedrock.converse(
+            messages=messages,
+            performanceConfig={"latency": "optimized"},
+            **CONVERSE_BASE_PARAMS
+        )
+    except (ClientError, ParamValidationError) as e:
+        if isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') != 'ValidationException':
+            raise
+        # Other validation failures (bad image, prompt too long) would fail again without it
+        message = str(e).lower()
+        if 'performance' not in message and 'latency' not in message:
+            raise
+        logger.warning(f"Latency-optimized inference unavailable for {MODEL_ID}: {str(e)}")
+        _latency_optimized = False
+        return bedrock.converse(messages=messages, **CONVERSE_BASE_PARAMS)
+
+def analyze_image_with_claude(image_bytes: bytes, prompt: str) -> str:
+    """
+    Analyze image using Claude Sonnet 4 Vision API via AWS Bedrock
+    """
+    try:
+        # Identical prompt + image already analyzed in this container
+        cache_key = result_cache_key(prompt, image_bytes)
+        if cache_key is not None and cache_key in _result_cache:
+            _result_cache.move_to_end(cache_key)
+            return _result_cache[cache_key]
 
         # Prepare message for Claude Vision API
         messages = [{
@@ -141,7 +323,7 @@ def analyze_image_with_claude(image_data: str, prompt: str) -> str:
                     "image": {
                         "format": "png",
                         "source": {
-                            "bytes": base64.b64decode(image_data)
+                            "bytes": image_bytes
                         }
                     }
                 }
@@ -149,24 +331,17 @@ def analyze_image_with_claude(image_data: str, prompt: str) -> str:
         }]
 
         # Call Bedrock Converse API
-        response = bedrock.converse(
-            modelId=model_id,
-            system=[{"text": system_prompt}],
-            messages=messages,
-            inferenceConfig={
-                "maxTokens": max_tokens,
-                "temperature": temperature
-            }
-        )
+        response = invoke_converse(messages)
 
         # Extract response text
         if 'output' in response and 'message' in response['output']:
             content = response['output']['message'].get('content', [])
-            result_text = ""
-            for item in content:
-                if item.get('text'):
-                    result_text += item['text']
-            return result_text.strip()
+            result_text = "".join(item['text'] for item in content if item.get('text')).strip()
+            if cache_key is not None:
+                _result_cache[cache_key] = result_text
+                if len(_result_cache) > RESULT_CACHE_SIZE:
+                    _result_cache.popitem(last=False)
+            return result_text
         else:
             return "画像分析が完了しましたが、結果の取得に失敗しました。"
 
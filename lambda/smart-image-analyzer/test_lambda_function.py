@@ -0,0 +1,256 @@
+"""
+Tests for the Smart Image Analysis Lambda Function
+Run with: python -m pytest lambda/smart-image-analyzer
+"""
+
+import base64
+import gzip
+import json
+import os
+import sys
+import types
+
+import pytest
+
+# Never open a network connection to Bedrock while importing the handler
+os.environ['PREWARM_BEDROCK'] = 'false'
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+try:
+    import boto3  # noqa: F401
+    import botocore  # noqa: F401
+except ImportError:
+    # Minimal stand-ins so the pure helpers can be tested without the AWS SDK
+    class _ClientError(Exception):
+        def __init__(self, error_response, operation_name):
+            self.response = error_response
+            super().__init__(error_response.get('Error', {}).get('Message', ''))
+
+    class _ParamValidationError(Exception):
+        def __init__(self, **kwargs):
+            super().__init__(kwargs.get('report', ''))
+
+    _config = types.ModuleType('botocore.config')
+    _config.Config = lambda **kwargs: kwargs
+    _exceptions = types.ModuleType('botocore.exceptions')
+    _exceptions.ClientError = _ClientError
+    _exceptions.ParamValidationError = _ParamValidationError
+    sys.modules.update({
+        'boto3': types.SimpleNamespace(client=lambda *args, **kwargs: types.SimpleNamespace(meta=None)),
+        'botocore': types.ModuleType('botocore'),
+        'botocore.config': _config,
+        'botocore.exceptions': _exceptions,
+    })
+
+import lambda_function  # noqa: E402
+
+IMAGE_BYTES = bytes(range(256)) * 1000 + b'tail'
+
+
+class TestRequestValidation:
+    @staticmethod
+    def post(body):
+        return lambda_function.lambda_handler({'httpMethod': 'POST', 'body': body}, None)
+
+    def test_missing_image_data(self):
+        assert self.post('{}')['statusCode'] == 400
+
+    @pytest.mark.parametrize('value', ['null', '123', '""', '["abc"]'])
+    def test_non_string_or_empty_image_data_is_client_error(self, value):
+        response = self.post('{"image_data": %s}' % value)
+        assert response['statusCode'] == 400
+        assert response['headers'] is lambda_function.CORS_HEADERS
+
+    def test_invalid_base64_is_client_error(self):
+        assert self.post('{"image_data": "QUJDR"}')['statusCode'] == 400
+
+    def test_oversized_image_data(self, monkeypatch):
+        monkeypatch.setattr(lambda_function, 'MAX_IMAGE_BYTES', 8)
+        assert self.post('{"image_data": "data:image/png;base64,QUJDREVGR0hJ"}')['statusCode'] == 413
+
+    def test_line_wrapped_image_at_the_limit_is_accepted(self, monkeypatch):
+        monkeypatch.setattr(lambda_function, 'MAX_IMAGE_BYTES', len(IMAGE_BYTES))
+        monkeypatch.setattr(lambda_function, 'bedrock', FakeBedrock())
+        wrapped = base64.encodebytes(IMAGE_BYTES).decode('ascii')
+        assert self.post(json.dumps({'image_data': wrapped}))['statusCode'] == 200
+
+
+class FakeBedrock:
+    """Records Converse calls; rejects performanceConfig with the given exception"""
+
+    def __init__(self, rejection=None):
+        self.rejection = rejection
+        self.calls = []
+
+    def converse(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.rejection is not None and 'performanceConfig' in kwargs:
+            raise self.rejection
+        return {'output': {'message': {'content': [{'text': 'ok'}]}}}
+
+
+def validation_error(message):
+    return lambda_function.ClientError(
+        {'Error': {'Code': 'ValidationException', 'Message': message}}, 'Converse'
+    )
+
+
+class TestInvokeConverse:
+    @pytest.fixture(autouse=True)
+    def optimized(self, monkeypatch):
+        monkeypatch.setattr(lambda_function, '_latency_optimized', True)
+
+    def test_unsupported_model_falls_back_and_disables(self, monkeypatch):
+        bedrock = FakeBedrock(validation_error('performanceConfig latency optimized is not supported for this model'))
+        monkeypatch.setattr(lambda_function, 'bedrock', bedrock)
+        lambda_function.invoke_converse([])
+        lambda_function.invoke_converse([])
+        assert ['performanceConfig' in call for call in bedrock.calls] == [True, False, False]
+        assert lambda_function._latency_optimized is False
+
+    def test_old_botocore_param_validation_falls_back(self, monkeypatch):
+        rejection = lambda_function.ParamValidationError(report='Unknown parameter in input: "performanceConfig"')
+        bedrock = FakeBedrock(rejection)
+        monkeypatch.setattr(lambda_function, 'bedrock', bedrock)
+        lambda_function.invoke_converse([])
+        assert len(bedrock.calls) == 2
+        assert lambda_function._latency_optimized is False
+
+    def test_unrelated_validation_error_is_not_retried(self, monkeypatch):
+        bedrock = FakeBedrock(validation_error('Could not process image'))
+        monkeypatch.setattr(lambda_function, 'bedrock', bedrock)
+        with pytest.raises(lambda_function.ClientError):
+            lambda_function.invoke_converse([])
+        assert len(bedrock.calls) == 1
+
+
+class TestPrewarm:
+    def test_ca_bundle_is_loaded_before_the_head_request(self, monkeypatch):
+        steps = []
+        endpoint_url = 'https://bedrock-runtime.us-east-1.amazonaws.com'
+        conn = types.SimpleNamespace(urlopen=lambda *args, **kwargs: steps.append(('urlopen', args, kwargs)))
+        pool_manager = types.SimpleNamespace(connection_from_url=lambda url: conn)
+        http_session = types.SimpleNamespace(
+            _verify='/opt/ca-bundle.pem',
+            _get_connection_manager=lambda url: pool_manager,
+            _setup_ssl_cert=lambda *args: steps.append(('ssl', args))
+        )
+        monkeypatch.setattr(lambda_function, 'bedrock', types.SimpleNamespace(
+            meta=types.SimpleNamespace(endpoint_url=endpoint_url),
+            _endpoint=types.SimpleNamespace(http_session=http_session)
+        ))
+        lambda_function._prewarm_bedrock_connection()
+        assert steps == [
+            ('ssl', (conn, endpoint_url, '/opt/ca-bundle.pem')),
+            ('urlopen', ('HEAD', '/'), {'timeout': lambda_function.PREWARM_TIMEOUT, 'retries': False}),
+        ]
+
+    def test_failures_do_not_break_init(self, monkeypatch):
+        monkeypatch.setattr(lambda_function, 'bedrock', types.SimpleNamespace())
+        lambda_function._prewarm_bedrock_connection()
+
+
+class TestImageDecoding:
+    @staticmethod
+    def sent_image(monkeypatch, image_data):
+        bedrock = FakeBedrock()
+        monkeypatch.setattr(lambda_function, 'bedrock', bedrock)
+        body = json.dumps({'image_data': image_data})
+        assert lambda_function.lambda_handler({'httpMethod': 'POST', 'body': body}, None)['statusCode'] == 200
+        return bedrock.calls[0]['messages'][0]['content'][1]['image']['source']['bytes']
+
+    @pytest.mark.parametrize('size', [1, 2, 3, 4, len(IMAGE_BYTES)])
+    def test_padded_and_unpadded_lengths(self, monkeypatch, size):
+        encoded = base64.b64encode(IMAGE_BYTES[:size]).decode('ascii')
+        assert self.sent_image(monkeypatch, encoded) == IMAGE_BYTES[:size]
+
+    def test_line_wrapped_and_whitespace_input(self, monkeypatch):
+        encoded = base64.encodebytes(IMAGE_BYTES).decode('ascii')
+        dirty = encoded[:1000] + ' \t' + encoded[1000:]
+        assert self.sent_image(monkeypatch, dirty) == IMAGE_BYTES
+
+
+class TestGzipResponse:
+    LARGE = lambda_function.response_builder(200, {'result': '分析結果' * 1000, 'status': 'success'})
+
+    def test_large_body_round_trips(self):
+        response = lambda_function.gzip_response(self.LARGE, {'headers': {'accept-encoding': 'gzip, deflate, br'}})
+        assert response['isBase64Encoded'] is True
+        assert response['headers']['Content-Encoding'] == 'gzip'
+        assert response['headers']['Vary'] == 'Accept-Encoding'
+        assert gzip.decompress(base64.b64decode(response['body'])).decode('utf-8') == self.LARGE['body']
+        assert 'Content-Encoding' not in lambda_function.CORS_HEADERS
+
+    def test_small_body_is_unchanged(self):
+        small = lambda_function.response_builder(200, {'result': 'ok'})
+        assert len(small['body']) < lambda_function.GZIP_MIN_BYTES
+        assert lambda_function.gzip_response(small, {'headers': {'accept-encoding': 'gzip'}}) is small
+
+    @pytest.mark.parametrize('event', [{}, {'headers': None}, {'headers': {'content-type': 'application/json'}}])
+    def test_without_accept_encoding_is_unchanged(self, event):
+        assert lambda_function.gzip_response(self.LARGE, event) is self.LARGE
+
+    @pytest.mark.parametrize('name', ['Accept-Encoding', 'ACCEPT-ENCODING', 'accept-Encoding'])
+    def test_mixed_case_header_name(self, name):
+        response = lambda_function.gzip_response(self.LARGE, {'headers': {name: 'GZIP'}})
+        assert response['isBase64Encoded'] is True
+
+
+class TestResultCache:
+    @pytest.fixture(autouse=True)
+    def fake(self, monkeypatch):
+        fake = FakeBedrock()
+        monkeypatch.setattr(lambda_function, 'bedrock', fake)
+        monkeypatch.setattr(lambda_function, 'TEMPERATURE', 0)
+        monkeypatch.setattr(lambda_function, 'RESULT_CACHE_SIZE', 2)
+        monkeypatch.setattr(lambda_function, '_result_cache', lambda_function.OrderedDict())
+        return fake
+
+    @staticmethod
+    def analyze(image, prompt='p'):
+        return lambda_function.analyze_image_with_claude(image, prompt)
+
+    @staticmethod
+    def key(image, prompt='p'):
+        return lambda_function.result_cache_key(prompt, image)
+
+    def test_hit_skips_bedrock(self, fake):
+        assert self.analyze(b'a') == 'ok'
+        assert self.analyze(b'a') == 'ok'
+        assert len(fake.calls) == 1
+
+    def test_prompt_is_part_of_key(self, fake):
+        self.analyze(b'a', 'p')
+        self.analyze(b'a', 'q')
+        assert len(fake.calls) == 2
+
+    def test_hit_moves_to_end(self):
+        self.analyze(b'a')
+        self.analyze(b'b')
+        self.analyze(b'a')
+        assert list(lambda_function._result_cache) == [self.key(b'b'), self.key(b'a')]
+
+    def test_evicts_least_recently_used(self, fake):
+        self.analyze(b'a')
+        self.analyze(b'b')
+        self.analyze(b'a')
+        self.analyze(b'c')
+        assert list(lambda_function._result_cache) == [self.key(b'a'), self.key(b'c')]
+        self.analyze(b'a')
+        assert len(fake.calls) == 3
+        self.analyze(b'b')
+        assert len(fake.calls) == 4
+
+    def test_nonzero_temperature_bypasses_cache(self, fake, monkeypatch):
+        monkeypatch.setattr(lambda_function, 'TEMPERATURE', 0.1)
+        self.analyze(b'a')
+        self.analyze(b'a')
+        assert len(fake.calls) == 2
+        assert not lambda_function._result_cache
+
+    def test_zero_size_disables_cache(self, fake, monkeypatch):
+        monkeypatch.setattr(lambda_function, 'RESULT_CACHE_SIZE', 0)
+        self.analyze(b'a')
+        self.analyze(b'a')
+        assert len(fake.calls) == 2
+        assert not lambda_function._result_cache